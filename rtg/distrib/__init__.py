@@ -38,6 +38,7 @@ class DistribTorch:
 
     _scaler = None
     _is_backend_ready = False
+    _barrier_group = None  # gloo group for coarse grained barriers; None => default group
     # singleton instance; lazy initialization
     _instance: ClassVar['DistribTorch'] = None
     _model: nn.Module = None
@@ -55,6 +56,10 @@ class DistribTorch:
             backend = 'nccl' if self.gpu_count > 0 else 'gloo'
             log.info(f"Initializing PyTorch distributed with '{backend}' backend:\n {self}")
             torch.distributed.init_process_group(init_method='env://', backend=backend)
+            if backend != 'gloo':
+                # barriers wait on the main process doing file IO, validation and tests;
+                # gloo is more tolerant than nccl for such long and uneven waits, and doesnt occupy GPU
+                self._barrier_group = torch.distributed.new_group(backend='gloo')
             self._is_backend_ready = True
         return self
 
@@ -89,7 +94,8 @@ class DistribTorch:
     def close(self):
         if self._is_backend_ready:
             log.warning("destroying distributed backend")
-            torch.distributed.destroy_process_group()
+            torch.distributed.destroy_process_group()  # all groups, including the barrier group
+            self._barrier_group = None
             self._is_backend_ready = False
 
     @classmethod
@@ -122,7 +128,7 @@ class DistribTorch:
 
     def barrier(self):
         if self.is_distributed:
-            torch.distributed.barrier()
+            torch.distributed.barrier(group=self._barrier_group)
         # else we dont need it
 
     def backward(self, loss, retain_graph=False):
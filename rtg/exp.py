@@ -1090,12 +1090,11 @@ class TranslationExperiment(BaseExperiment):
             transform = TextTransform.recommended_pre()
         return transform
 
-    def get_post_transform(self, side: str):
+    def get_post_transform_chain(self, side: str) -> Optional[List[str]]:
+        """names of post processors in config; None when not configured i.e. use the recommended"""
         assert side in ('src', 'tgt')
+        return self.config.get('prep', {}).get(f'{side}_post_proc', None)
+
+    def get_post_transform(self, side: str):
         from rtg.transform import TextTransform
-        conf_chain = self.config.get('prep', {}).get(f'{side}_post_proc', None)
-        if conf_chain:
-            transform = TextTransform.make(names=conf_chain)
-        else:
-            transform = TextTransform.recommended_post()
-        return transform
+        return TextTransform.make_post(self.get_post_transform_chain(side))
@@ -203,6 +203,63 @@ class Decoder:
             gen_args['multi_label'] = True
         return cls(model, spec.Generator, exp, gen_args)
 
+    def compile(self, cache_dir: Optional[Path] = None, **compile_args) -> bool:
+        """
+        Compiles the model with torch.compile (requires torch 2.0+).
+        Generators call model.encode() and model.decode() instead of model.forward(),
+        so the forward of encoder and decoder submodules are compiled instead of the whole model.
+        If compilation fails, either here or lazily on a later call, the model runs eagerly instead.
+        :param cache_dir: optional dir to persist compiled artifacts, so that later runs skip the warmup
+        :param compile_args: args to torch.compile; e.g. mode='reduce-overhead'
+        :return: True if compiled, False otherwise
+        """
+        if not hasattr(torch, 'compile'):
+            log.warning(f"torch.compile is unavailable in torch {torch.__version__}; skipping it")
+            return False
+        names = [name for name in ('encoder', 'decoder')
+                 if isinstance(getattr(self.model, name, None), nn.Module)]
+        if not names:
+            log.warning(f"Dont know how to compile {type(self.model)}; skipping it")
+            return False
+        try:
+            import torch._dynamo
+            import torch._inductor.config
+            # decoding sees many batch, beam and sequence lengths; avoid the recompilation limit
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 10_000)
+            if cache_dir and hasattr(torch._inductor.config, 'fx_graph_cache'):  # torch 2.1+
+                cache_dir.mkdir(parents=True, exist_ok=True)
+                os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', str(cache_dir))
+                torch._inductor.config.fx_graph_cache = True
+                log.info(f"Compiled graphs are cached at {os.environ['TORCHINDUCTOR_CACHE_DIR']}")
+            forwards = {name: self._compiled_forward(getattr(self.model, name), name, **compile_args)
+                        for name in names}
+        except Exception:
+            log.exception("torch.compile failed; decoding without it")
+            return False
+        for name, forward in forwards.items():
+            getattr(self.model, name).forward = forward  # instance attribute shadows the class method
+        log.info(f"Compiled model.{names} with {compile_args}")
+        return True
+
+    @staticmethod
+    def _compiled_forward(module: nn.Module, name: str, **compile_args):
+        """
+        Compiles module.forward; the errors of torch.compile surface only at the first few calls,
+        so on the first error, this restores the eager forward of the module for all later calls.
+        """
+        eager_forward = module.forward
+        compiled_forward = torch.compile(eager_forward, **compile_args)
+
+        def forward(*args, **kwargs):
+            try:
+                return compiled_forward(*args, **kwargs)
+            except Exception:
+                log.exception(f"Compiled model.{name} failed; falling back to eager mode")
+                module.__dict__.pop('forward', None)  # undo the compile for later calls
+                return eager_forward(*args, **kwargs)
+
+        return forward
+
     def greedy_decode(self, x_seqs, x_lens, max_len, **args) -> List[Hypothesis]:
         """
         Implements a simple greedy decoder
@@ -578,8 +635,12 @@ class Decoder:
     def _remove_null_vals(args: Dict):
         return {k: v for k, v in args.items() if v is not None}  # remove None args
 
-    def decode_file(self, inp: Iterator[str], out: StringIO, beam_size=default_beam_size,
-                    num_hyp=1, batch_size=1, max_src_len=-1, **args):
+    def decode_iter(self, inp: Iterator[str], beam_size=default_beam_size, num_hyp=1, batch_size=1,
+                    max_src_len=-1, **args) -> Iterator[Tuple[str, List[StrHypothesis], Any]]:
+        """
+        Decodes input lines
+        :return: stream of (src, hypotheses, id) in the same order as inp
+        """
         args = self._remove_null_vals(args)
         log.info(f"Args to decoder : {args} and num_hyp={num_hyp} "
                  f"batch_size={batch_size} max_src_len={max_src_len}")
@@ -632,13 +693,21 @@ class Decoder:
             for _, src, result, _id in buffer:
                 yield src, result, _id
 
-        streamed_results: Iterator[Tuple[str, List[StrHypothesis], Any]] = _decode_all()
+        return _decode_all()
+
+    @staticmethod
+    def format_hyps(hyps: List[StrHypothesis], _id=None, num_hyp=1) -> str:
+        """formats hypotheses of a source line as text for the output file"""
+        prefix = f'{_id}\t' if _id else ''  # optional Id
+        out_line = '\n'.join(f'{prefix}{hyp}\t{score:.4f}' for score, hyp in hyps)
+        return f'{out_line}\n' + ('\n' if num_hyp > 1 else '')
+
+    def decode_file(self, inp: Iterator[str], out: StringIO, beam_size=default_beam_size,
+                    num_hyp=1, batch_size=1, max_src_len=-1, **args):
+        streamed_results = self.decode_iter(inp, beam_size=beam_size, num_hyp=num_hyp, batch_size=batch_size,
+                                            max_src_len=max_src_len, **args)
         for src, hyps, _id in streamed_results:
-            prefix = f'{_id}\t' if _id else ''  # optional Id
-            out_line = '\n'.join(f'{prefix}{hyp}\t{score:.4f}' for score, hyp in hyps)
-            out.write(f'{out_line}\n')
-            if num_hyp > 1:
-                out.write('\n')
+            out.write(self.format_hyps(hyps, _id=_id, num_hyp=num_hyp))
 
     def decode_stream(self, inp: Iterator[str], out: StringIO,
                       max_src_len=-1, **args):
@@ -2,11 +2,16 @@
 #
 # Author: Thamme Gowda [tg (at) isi (dot) edu] 
 # Created: 4/26/21
+import inspect
+import math
+from contextlib import contextmanager
 from dataclasses import dataclass
 
 from rtg import log
 from rtg.registry import register, SCHEDULE
-from torch import optim
+import torch
+from torch import optim, nn
+from torch.nn.parallel import DistributedDataParallel
 
 from rtg.distrib import DistribTorch
 
@@ -30,9 +35,15 @@ class Noam(LRSchedule):
     constant: int
     model_dim: int
 
+    def __post_init__(self):
+        # the two terms of min(step ** -0.5, step * warmup ** -1.5) cross at step == warmup
+        self._warmup_factor = self.constant * self.model_dim ** -0.5 * self.warmup ** -1.5
+        self._decay_factor = self.constant * self.model_dim ** -0.5
+
     def rate(self, step) -> float:
-        return self.constant * self.model_dim ** -0.5 * min(step ** -0.5,
-                                                            step * self.warmup ** -1.5)
+        if step < self.warmup:
+            return self._warmup_factor * step
+        return self._decay_factor / math.sqrt(step)
 
 
 @register(SCHEDULE, 'inverse_root')
@@ -69,13 +80,13 @@ class InverseSqrt(LRSchedule):
     def __post_init__(self):
         assert self.init_lr < self.peak_lr, f'init_lr must be lower than peak_lr'
         assert self.constant > 0
+        self._warmup_slope = (self.peak_lr - self.init_lr) / self.warmup
+        self._decay_factor = self.constant * self.peak_lr * math.sqrt(self.warmup)
 
     def rate(self, step) -> float:
         if step <= self.warmup:
-            lr = self.init_lr + step * (self.peak_lr - self.init_lr) / self.warmup
-        else:
-            lr = self.peak_lr * self.warmup ** 0.5 * step ** -0.5
-        return self.constant * lr
+            return self.constant * (self.init_lr + step * self._warmup_slope)
+        return self._decay_factor / math.sqrt(step)
 
 
 @dataclass
@@ -91,7 +102,11 @@ class ScheduledOptimizer:
             log.warning("Learning rate schedule is not configured; letting optimizer handle itself")
 
     def step(self, closure=None):
-        "Update parameters and rate"
+        """
+        Update parameters and rate.
+        When accumulating gradients of a DistributedDataParallel model, wrap the backward passes
+        between two steps with maybe_no_sync(), so that gradients are all-reduced only once per step
+        """
         self._step += 1
         if self.schedule is not None:
             rate = self.schedule.rate(step=self._step)
@@ -113,6 +128,21 @@ class ScheduledOptimizer:
                 break
         self.optimizer.step(closure=closure)
 
+    @staticmethod
+    @contextmanager
+    def maybe_no_sync(model: nn.Module, is_accumulating: bool):
+        """
+        Skips the gradient all-reduce of DistributedDataParallel for backward passes that
+        only accumulate gradients; other models are not affected
+        :param model: model, maybe wrapped in DistributedDataParallel
+        :param is_accumulating: True if the optimizer step does not follow this backward pass
+        """
+        if is_accumulating and isinstance(model, DistributedDataParallel):
+            with model.no_sync():
+                yield
+        else:
+            yield
+
     @property
     def param_groups(self):
         return self.optimizer.param_groups
@@ -131,6 +161,15 @@ class ScheduledOptimizer:
     @classmethod
     def get_vaswani_etal_opt(cls, model_params, model_dim=512):
         """The optimizer used in Attention is all you need"""
+        # may be generators of params or of param groups; materialize as they are iterated more than once
+        model_params = [dict(x, params=[x['params']] if torch.is_tensor(x['params']) else list(x['params']))
+                        if isinstance(x, dict) else x for x in model_params]
+        params = [p for x in model_params for p in (x['params'] if isinstance(x, dict) else [x])]
+        adam_args = {}
+        if ('fused' in inspect.signature(optim.Adam).parameters
+                and params and all(p.is_cuda and p.is_floating_point() for p in params)):
+            # single kernel update over all params; capturable keeps the step on GPU (CUDA graph friendly)
+            adam_args = dict(fused=True, capturable=True)
         return cls(start_step=0,
                    schedule=Noam(warmup=4000, constant=2, model_dim=model_dim),
-                   optimizer=optim.Adam(model_params, lr=0, betas=(0.9, 0.98), eps=1e-9))
+                   optimizer=optim.Adam(model_params, lr=0, betas=(0.9, 0.98), eps=1e-9, **adam_args))
@@ -361,7 +361,8 @@ class SublayerConnection(nn.Module):
         return x + self.dropout(sublayer(self.norm(x)))
 
 
-def attention(query, key, value, mask=None, dropout=None, query_key_emb: 'RelativePositionEmbedding'=None):
+def attention(query, key, value, mask=None, dropout=None, query_key_emb: 'RelativePositionEmbedding'=None,
+              need_attn=True):
     """
     Compute 'Scaled Dot Product Attention'
     :param query:
@@ -370,8 +371,21 @@ def attention(query, key, value, mask=None, dropout=None, query_key_emb: 'Relati
     :param mask:
     :param dropout:
     :param query_key_emb:
-    :return:
+    :param need_attn: whether attention probabilities are needed. When they are not needed,
+       the fused kernel (torch 2.0+) is used, which does not materialize the attention matrix.
+       Rows that are fully masked attend uniformly to all positions, same as the unfused path
+    :return: context values, attention probabilities (None when need_attn=False and fused kernel is used)
     """
+    if not need_attn and query_key_emb is None and hasattr(F, 'scaled_dot_product_attention'):
+        # flash / memory efficient kernels; mask: True => take part in attention
+        dropout_p = dropout.p if dropout is not None and dropout.training else 0.0
+        attn_mask = None
+        if mask is not None:
+            attn_mask = mask != 0
+            # fully masked rows would be NaN; unmask them to get uniform attention, like masked_fill(-1e9)
+            attn_mask = attn_mask | ~attn_mask.any(dim=-1, keepdim=True)
+        ctx_vals = F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask, dropout_p=dropout_p)
+        return ctx_vals, None
 
     d_k = query.size(-1)
     # Beware: this is a batch multiplier!
@@ -490,7 +504,9 @@ class MultiHeadedAttention(nn.Module):
         # Q,K,V  --> input, linear: [BatchSize x SeqLen x ModelDim]
         #        --> view: [BatchSize x SeqLen x Heads x ModelDim/Heads ]
         #        --> transpose: [BatchSize x Heads x SeqLen x ModelDim/Heads ]
-        x, attn = attention(query, key, value, mask=mask, dropout=self.dropout, query_key_emb=self.rel_pos_emb)
+        # fused attention at inference only; training is unchanged
+        x, attn = attention(query, key, value, mask=mask, dropout=self.dropout, query_key_emb=self.rel_pos_emb,
+                            need_attn=self.cache_attn or self.training)
         if self.cache_attn:  # dont cache this at training time
             self.attn = attn.detach()
         # attn: [BatchSize x Heads x SeqLen_query x SeqLen_value ]
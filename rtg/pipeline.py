@@ -4,35 +4,97 @@
 # Created: 3/9/19
 
 import argparse
+import math
 import os
-from rtg import log, TranslationExperiment as Experiment, __version__, debug_mode
+import multiprocessing as mp
+from rtg import log, TranslationExperiment as Experiment, __version__, debug_mode, cpu_count
 from rtg.exp import load_conf
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 from rtg.module.decoder import Decoder
-from rtg.utils import IO, line_count
+from rtg.utils import IO, cached_line_count
 from dataclasses import dataclass
 import torch
 import random
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
-from sacrebleu import corpus_bleu, corpus_macrof
+from sacrebleu import corpus_macrof
+from sacrebleu.metrics import BLEU
 import inspect
 import copy
 import json
 from rtg.distrib import dtorch
 from rtg.registry import ProblemType
+from rtg.transform import TextTransform
+
+_detok_post_proc: Optional[TextTransform] = None  # one per detokenizer worker process
+
+
+def _init_detok_worker(chain: Optional[List[str]]):
+    # transforms hold lambdas and bound methods which dont pickle, so each worker builds its own
+    global _detok_post_proc
+    _detok_post_proc = TextTransform.make_post(chain)
+
+
+def _detok_worker(line: str) -> str:
+    return _detok_post_proc(line.split('\t')[0])
+
+
+def quasi_random_choices(n: int, *choices: Sequence) -> List[Tuple]:
+    """
+    Samples n combinations, picking one item from each of the given choices.
+    Scrambled Sobol sequence covers the space more evenly than independent random choices;
+     falls back to random choices when scipy (>= 1.7) is unavailable
+    :param n: number of combinations
+    :param choices: candidate values for each dimension
+    :return: list of n tuples
+    """
+    try:
+        from scipy.stats import qmc
+    except ImportError:
+        log.warning("scipy.stats.qmc is unavailable; using random choices. pip install 'scipy>=1.7'")
+        return [tuple(random.choice(c) for c in choices) for _ in range(n)]
+    # Sobol points are balanced when their count is a power of 2
+    points = qmc.Sobol(d=len(choices), scramble=True).random_base2(m=math.ceil(math.log2(max(n, 1))))[:n]
+    return [tuple(c[min(int(x * len(c)), len(c) - 1)] for c, x in zip(choices, point))
+            for point in points]
+
+
+AUTOCAST_DTYPES = ('bfloat16', 'float16')
+
+
+def decode_autocast(tester_args: Optional[dict] = None) -> torch.autocast:
+    """
+    Autocast context for decoding, as configured by tester.autocast_dtype.
+    Defaults to bfloat16 on GPUs that support it (whose matmuls go through tensor cores on Ampere or newer);
+    set autocast_dtype to null in config to decode in full precision.
+    :param tester_args: tester block of experiment config
+    :return: torch.autocast context manager; disabled on CPU
+    """
+    tester_args = tester_args or {}
+    dtype = tester_args.get('autocast_dtype', 'bfloat16' if torch.cuda.is_available()
+                            and torch.cuda.is_bf16_supported() else None)
+    if dtype and dtype not in AUTOCAST_DTYPES:
+        raise ValueError(f'tester.autocast_dtype={dtype!r} is invalid; expected one of {AUTOCAST_DTYPES} or null')
+    enabled = bool(dtype) and torch.cuda.is_available()
+    log.debug(f"Decoder autocast: enabled={enabled} dtype={dtype}")
+    return torch.autocast(device_type='cuda', dtype=getattr(torch, dtype or 'bfloat16'), enabled=enabled)
 
 
 @dataclass
 class Pipeline:
     exp: Experiment
+    max_cached_decoders: int = 2  # each decoder holds model(s) in GPU memory
 
     def __post_init__(self):
         self.tests_types = {
             ProblemType.TRANSLATION: self.run_translation_tests,
             ProblemType.CLASSIFICATION: self.run_classification_tests
         }
+        # BLEU metrics with reference statistics precomputed; reused when tuning on the same refs
+        self._bleu_cache: Dict[Tuple, BLEU] = {}
+        # loading models (and ensembling) is costly; reuse them across tuning trials and tests
+        self._decoder_cache: Dict[Tuple, Decoder] = OrderedDict()  # least recently used first
 
     def pre_checks(self):
         # Some more validation needed
@@ -58,7 +120,7 @@ class Pipeline:
             if ref:
                 ref = Path(ref).resolve()
                 assert ref.exists(), f'{ref} doesnt exist'
-                assert line_count(src) == line_count(ref), f'{src} and{ref} are not parallel'
+                assert cached_line_count(src) == cached_line_count(ref), f'{src} and{ref} are not parallel'
         assert conf['trainer']['steps'] > 0
         if 'finetune_steps' in conf['trainer']:
             assert conf['trainer']['finetune_steps'] > conf['trainer']['steps']
@@ -68,24 +130,94 @@ class Pipeline:
                 assert Path(conf['prep']['finetune_src']).exists()
                 assert Path(conf['prep']['finetune_tgt']).exists()
 
-    def detokenize(self, inp: Path):
-        post_proc = self.exp.get_post_transform(side='tgt')
+    def detokenize_lines(self, lines: Iterable[str], n_lines: Optional[int] = None,
+                         chunk_size=1024) -> Iterator[str]:
+        """
+        Detokenizes lines using the tgt post processor
+        :param lines: stream of tokenized lines; only the first column of TSV lines is used
+        :param n_lines: number of lines, if known; used for sizing the worker pool
+        :param chunk_size: number of lines sent to a worker at a time
+        :return: stream of detokenized lines, in the same order as input
+        """
+        if n_lines is None and isinstance(lines, list):
+            n_lines = len(lines)
+        n_workers = cpu_count if n_lines is None else min(cpu_count, math.ceil(n_lines / chunk_size))
+        if n_workers <= 1:  # forking a pool costs more than it saves
+            post_proc = self.exp.get_post_transform(side='tgt')
+            yield from (post_proc(line.split('\t')[0]) for line in lines)
+            return
+        chain = self.exp.get_post_transform_chain(side='tgt')
+        # detokenization is independent per line, so spread it across CPUs and stream results in order.
+        # dont fork: this process may hold a CUDA context and torch threads; workers need only the chain
+        ctx = mp.get_context('forkserver' if 'forkserver' in mp.get_all_start_methods() else 'spawn')
+        with ctx.Pool(n_workers, initializer=_init_detok_worker, initargs=(chain,)) as pool:
+            yield from pool.imap(_detok_worker, lines, chunksize=chunk_size)
+
+    def detokenize(self, inp: Path, chunk_size=1024):
         detok_file = inp.with_suffix('.detok')
-        with inp.open() as lines, detok_file.open('w') as out:
-            for line in lines:
-                line = line.split('\t')[0]
-                out.write(post_proc(line) + '\n')
+        with inp.open() as lines:
+            detok_lines = self.detokenize_lines(lines, n_lines=cached_line_count(inp), chunk_size=chunk_size)
+            IO.write_lines(detok_file, detok_lines)
         return detok_file
 
-    def evaluate_mt_file(self, detok_hyp: Path, ref: Union[Path, List[str]], lowercase=True) -> float:
-        detok_lines = list(IO.get_lines(detok_hyp))
+    def get_bleu_metric(self, ref: List[str], lowercase=True) -> BLEU:
+        """
+        Gets BLEU metric whose reference n-gram statistics are cached, so that evaluating
+        many hypotheses against the same in-memory reference (e.g. while tuning) does not reprocess it.
+        See clear_bleu_cache()
+        :param ref: reference lines
+        :param lowercase: case insensitive BLEU
+        :return: BLEU metric
+        """
+        key = (len(ref), hash(tuple(ref)), lowercase)
+        if key not in self._bleu_cache:
+            self._bleu_cache[key] = BLEU(lowercase=lowercase, references=[ref])
+        return self._bleu_cache[key]
+
+    def clear_bleu_cache(self):
+        self._bleu_cache.clear()
+
+    def get_decoder(self, exp: Experiment, ensemble: int) -> Decoder:
+        _, step = exp.get_last_saved_model()
+        key = (str(exp.work_dir), step, ensemble)
+        if key in self._decoder_cache:
+            self._decoder_cache.move_to_end(key)
+        else:
+            evicted = False
+            while len(self._decoder_cache) >= max(self.max_cached_decoders, 1):
+                self._decoder_cache.popitem(last=False)  # free memory before loading another one
+                evicted = True
+            if evicted and torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            self._decoder_cache[key] = Decoder.new(exp, ensemble=ensemble)
+        return self._decoder_cache[key]
+
+    def clear_decoders(self, keep_ensembles: Iterable[int] = ()):
+        """
+        Evicts cached decoders and releases their GPU memory
+        :param keep_ensembles: ensemble sizes whose decoders are retained
+        """
+        keep_ensembles = set(keep_ensembles)
+        for key in [k for k in self._decoder_cache if k[-1] not in keep_ensembles]:
+            del self._decoder_cache[key]
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def evaluate_mt_file(self, detok_hyp: Path, ref: Union[Path, List[str]], lowercase=True,
+                         hyp_lines: Optional[List[str]] = None) -> float:
+        # hyp_lines: contents of detok_hyp, if they are already in memory
+        detok_lines = hyp_lines if hyp_lines is not None else list(IO.get_lines(detok_hyp))
         # takes multiple refs, but here we have only one
         if isinstance(ref, Path):
+            # test suites are scored once each; caching their statistics would only hold memory
             ref = [x.strip() for x in IO.get_lines(ref)]
+            bleu_metric, bleu_refs = BLEU(lowercase=lowercase), [ref]
+        else:
+            bleu_metric, bleu_refs = self.get_bleu_metric(ref, lowercase=lowercase), None
         assert isinstance(ref, list), f'List of strings expected, but given {type(ref)} '
         assert isinstance(ref[0], str), f'List of strings expected, but given List of {type(ref[0])} '
         refs = [ref]
-        bleu = corpus_bleu(hypotheses=detok_lines, references=refs, lowercase=lowercase)
+        bleu = bleu_metric.corpus_score(detok_lines, bleu_refs)
         bleu_str = bleu.format()
         bleu_file = detok_hyp.with_name(detok_hyp.name + ('.lc' if lowercase else '.oc') + '.sacrebleu')
         log.info(f'{detok_hyp}: {bleu_str}')
@@ -100,25 +232,33 @@ class Pipeline:
     def decode_eval_file(self, decoder, src: Union[Path, List[str]], out_file: Path,
                          ref: Optional[Union[Path, List[str]]],
                          lowercase: bool = True, **dec_args) -> float:
-        if out_file.exists() and out_file.stat().st_size > 0 and line_count(out_file) == (
-                len(src) if isinstance(src, list) else line_count(src)):
+        if out_file.exists() and out_file.stat().st_size > 0 and cached_line_count(out_file) == (
+                len(src) if isinstance(src, list) else cached_line_count(src)):
             log.warning(f"{out_file} exists and has desired number of lines. Skipped...")
+            detok_hyp, detok_lines = self.detokenize(out_file), None
         else:
             if isinstance(src, Path):
                 log.info(f"decoding {src.name}")
-                src = list(IO.get_lines(src))
-            if isinstance(ref, Path):
-                ref = list(IO.get_lines(ref))
+                src = IO.get_lines(src)  # stream; decoder reads it once
+            # hypotheses are written and detokenized while in memory; no re-reading of out_file
+            num_hyp = dec_args.get('num_hyp', 1)
+            tok_lines = []
             with IO.writer(out_file) as out:
-                decoder.decode_file(src, out, **dec_args)
-        detok_hyp = self.detokenize(out_file)
+                for _, hyps, _id in decoder.decode_iter(src, **dec_args):
+                    text = decoder.format_hyps(hyps, _id=_id, num_hyp=num_hyp)
+                    out.write(text)
+                    tok_lines.extend(text[:-1].split('\n'))  # same lines as reading the file back
+            detok_hyp = out_file.with_suffix('.detok')
+            detok_lines = [line.strip() for line in self.detokenize_lines(tok_lines)]
+            IO.write_lines(detok_hyp, detok_lines)
         if ref:
-            return self.evaluate_mt_file(detok_hyp, ref, lowercase=lowercase)
+            return self.evaluate_mt_file(detok_hyp, ref, lowercase=lowercase, hyp_lines=detok_lines)
 
     def tune_decoder_params(self, exp: Experiment, tune_src: str, tune_ref: str, batch_size: int,
                             trials: int = 10, lowercase=True,
                             beam_size=(1, 4, 8), ensemble=(1, 5, 10), lp_alpha=(0.0, 0.4, 0.6),
                             suggested: List[Tuple[int, int, float]] = None,
+                            prune_after_n_lines: int = 200,
                             **fixed_args):
         _, _, _, tune_args = inspect.getargvalues(inspect.currentframe())
         tune_args.update(fixed_args)
@@ -138,51 +278,98 @@ class Pipeline:
         tune_src, tune_ref = list(IO.get_lines(tune_src)), list(IO.get_lines(tune_ref))
         assert len(tune_src) == len(tune_ref)
 
-        tune_log = tune_dir / 'scores.json'  # resume the tuning
+        tune_log = tune_dir / 'scores.jsonl'  # resume the tuning
         memory: Dict[Tuple, float] = {}
-        if tune_log.exists():
-            data = json.load(tune_log.open())
-            # JSON keys cant be tuples, so they were stringified
-            memory = {eval(k): v for k, v in data.items()}
-
-        beam_sizes, ensembles, lp_alphas = [], [], []
+        old_tune_log = tune_dir / 'scores.json'
+        if old_tune_log.exists():  # from older versions; JSON keys cant be tuples, so they were stringified
+            data = json.load(old_tune_log.open())
+            memory.update({eval(k): v for k, v in data.items()})
+        memory.update(self._load_scores(tune_log))
+        pruning = 0 < prune_after_n_lines < len(tune_src)
+        n = prune_after_n_lines
+        partial_log = tune_dir / f'scores_n{n}.jsonl'  # scores on the first n lines; for pruning
+        partial: Dict[Tuple, float] = self._load_scores(partial_log) if pruning else {}
+
+        candidates: List[Tuple[int, int, float]] = []
         if suggested:
             if isinstance(suggested[0], str):
                 suggested = [eval(x) for x in suggested]
             suggested = [(x[0], x[1], round(x[2], 2)) for x in suggested]
-            suggested_new = [x for x in suggested if x not in memory]
-            beam_sizes += [x[0] for x in suggested_new]
-            ensembles += [x[1] for x in suggested_new]
-            lp_alphas += [x[2] for x in suggested_new]
+            candidates += [x for x in suggested if x not in memory]
+        suggested = set(suggested or [])
 
-        new_trials = trials - len(memory)
+        new_trials = trials - len(set(memory) | set(partial))  # pruned candidates count too
         if new_trials > 0:
-            beam_sizes += [random.choice(beam_size) for _ in range(new_trials)]
-            ensembles += [random.choice(ensemble) for _ in range(new_trials)]
-            lp_alphas += [round(random.choice(lp_alpha), 2) for _ in range(new_trials)]
+            sampled = quasi_random_choices(new_trials, beam_size, ensemble, lp_alpha)
+            candidates += [(b_s, ens, round(lp_a, 2)) for b_s, ens, lp_a in sampled]
+        candidates = [x for x in dict.fromkeys(candidates) if x not in memory]  # drop duplicates
 
+        try:
+            # sampled candidates are ranked on prefix; suggested ones are always decoded on the full tune set
+            pool = [x for x in dict.fromkeys(list(partial) + candidates) if x not in suggested]
+            n_survivors = math.ceil(math.sqrt(len(pool)))
+            if pruning and n_survivors < len(pool):
+                # successive halving: rank all candidates on a prefix of tune set,
+                # and then decode the full tune set with only the top few
+                log.info(f"Pruning {len(pool)} candidates to {n_survivors} using first {n} lines")
+                self._decode_eval_trials(exp, [x for x in pool if x not in partial], tune_src[:n], tune_ref[:n],
+                                         tune_dir, name_prefix=f'tune_step{step}_n{n}', scores=partial,
+                                         scores_log=partial_log, batch_size=batch_size, lowercase=lowercase,
+                                         **fixed_args)
+                survivors = sorted(pool, key=lambda x: partial[x], reverse=True)[:n_survivors]
+                candidates = [x for x in candidates if x in suggested] + \
+                             [x for x in survivors if x not in memory]
+                self.clear_decoders(keep_ensembles={ens for _, ens, _ in candidates})
+            self._decode_eval_trials(exp, candidates, tune_src, tune_ref, tune_dir,
+                                     name_prefix=f'tune_step{step}', scores=memory, scores_log=tune_log,
+                                     batch_size=batch_size, lowercase=lowercase, **fixed_args)
+            best_params, _ = max(memory.items(), key=lambda x: x[1])
+            return dict(zip(['beam_size', 'ensemble', 'lp_alpha'], best_params)), tune_args
+        finally:
+            self.clear_bleu_cache()  # tune references are not needed anymore
+
+    @staticmethod
+    def _load_scores(scores_log: Path) -> Dict[Tuple, float]:
+        """Loads (beam_size, ensemble, lp_alpha) -> score from JSONL file written by _decode_eval_trials"""
+        scores = {}
+        if scores_log.exists():
+            for line in IO.get_lines(scores_log, col=-1):
+                if line.strip():
+                    rec = json.loads(line)
+                    scores[tuple(rec['key'])] = rec['score']
+        return scores
+
+    def _decode_eval_trials(self, exp: Experiment, candidates: List[Tuple[int, int, float]],
+                            src: List[str], ref: List[str], out_dir: Path, name_prefix: str,
+                            scores: Dict[Tuple, float], batch_size: int, lowercase=True,
+                            scores_log: Optional[Path] = None, **fixed_args):
+        """
+        Decodes and evaluates each of (beam_size, ensemble, lp_alpha) candidates
+        :param scores: the scores are stored in this dictionary, as and when they are available
+        :param scores_log: optional JSONL file to append the scores to, as and when they are available
+        """
         # ensembling is somewhat costlier, so try minimize the model ensembling, by grouping them together
         grouped_ens = defaultdict(list)
-        for b, ens, l in zip(beam_sizes, ensembles, lp_alphas):
+        for b, ens, l in candidates:
             grouped_ens[ens].append((b, l))
-        try:
-            for ens, args in grouped_ens.items():
-                decoder = Decoder.new(exp, ensemble=ens)
-                for b_s, lp_a in args:
-                    eff_batch_size = batch_size // b_s  # effective batch size
-                    name = f'tune_step{step}_beam{b_s}_ens{ens}_lp{lp_a:.2f}'
-                    log.info(name)
-                    out_file = tune_dir / f'{name}.out.tsv'
-                    score = self.decode_eval_file(decoder, tune_src, out_file, tune_ref,
+        for ens in grouped_ens:
+            # growing beam sizes lets torch's caching allocator reuse buffers of the previous trial
+            grouped_ens[ens].sort(key=lambda ba: ba[0])
+        for ens, args in grouped_ens.items():
+            decoder = self.get_decoder(exp, ensemble=ens)
+            for b_s, lp_a in args:
+                eff_batch_size = batch_size // b_s  # effective batch size
+                name = f'{name_prefix}_beam{b_s}_ens{ens}_lp{lp_a:.2f}'
+                log.info(name)
+                out_file = out_dir / f'{name}.out.tsv'
+                with decode_autocast(exp.config.get('tester')):
+                    score = self.decode_eval_file(decoder, src, out_file, ref,
                                                   batch_size=eff_batch_size, beam_size=b_s,
                                                   lp_alpha=lp_a, lowercase=lowercase, **fixed_args)
-                    memory[(b_s, ens, lp_a)] = score
-            best_params = sorted(memory.items(), key=lambda x: x[1], reverse=True)[0][0]
-            return dict(zip(['beam_size', 'ensemble', 'lp_alpha'], best_params)), tune_args
-        finally:
-            # JSON keys cant be tuples, so we stringify them
-            data = {str(k): v for k, v in memory.items()}
-            IO.write_lines(tune_log, json.dumps(data))
+                scores[(b_s, ens, lp_a)] = score
+                if scores_log:
+                    with IO.writer(scores_log, append=True) as out:
+                        out.write(json.dumps(dict(key=[b_s, ens, lp_a], score=score)) + '\n')
 
     def run_classification_tests(self, exp=None, args=None):
         from rtg.emb.tfmcls import ClassificationExperiment
@@ -253,6 +440,7 @@ class Pipeline:
         max_len = best_params.get('max_len', 50)
         batch_size = best_params.get('batch_size', 20_000)
         # TODO: this has grown to become messy (trying to make backward compatible, improve the logic here
+        decode_autocast(args)  # validates tester.autocast_dtype early, before tuning and tests
         if 'tune' in dec_args and not dec_args['tune'].get('tuned'):
             tune_args: Dict = dec_args['tune']
             prep_args = exp.config['prep']
@@ -285,7 +473,13 @@ class Pipeline:
         log.info(f"Test Dir = {test_dir}")
         test_dir.mkdir(parents=True, exist_ok=True)
 
-        decoder = Decoder.new(exp, ensemble=ensemble)
+        self.clear_decoders(keep_ensembles=[ensemble])  # the other ensembles were needed for tuning only
+        decoder = self.get_decoder(exp, ensemble=ensemble)
+        compile_args = args.get('compile', False)  # opt-in; true or a dict of args to torch.compile
+        if compile_args and torch.cuda.is_available():
+            if not isinstance(compile_args, dict):
+                compile_args = dict(mode='reduce-overhead', dynamic=True)
+            decoder.compile(cache_dir=exp.work_dir / 'compile_cache', **compile_args)
         for name, data in suite.items():
             # noinspection PyBroadException
             src, ref = data, None
@@ -310,13 +504,15 @@ class Pipeline:
                 out_file = test_dir / f'{name}.out.tsv' if not out_file else out_file
                 out_file.parent.mkdir(parents=True, exist_ok=True)
 
-                self.decode_eval_file(decoder, src_link, out_file, ref_link,
-                                      batch_size=eff_batch_size, beam_size=beam_size,
-                                      lp_alpha=lp_alpha, max_len=max_len)
+                with decode_autocast(args):
+                    self.decode_eval_file(decoder, src_link, out_file, ref_link if ref else None,
+                                          batch_size=eff_batch_size, beam_size=beam_size,
+                                          lp_alpha=lp_alpha, max_len=max_len)
             except Exception as e:
                 log.exception(f"Something went wrong with '{name}' test")
                 err = test_dir / f'{name}.err'
                 err.write_text(str(e))
+        self.clear_decoders()
 
     def run(self, run_tests=True, debug=debug_mode):
         if not self.exp.read_only:
@@ -342,7 +538,8 @@ class Pipeline:
             if self.exp.problem_type in self.tests_types:
                 if dtorch.is_global_main:
                     self.exp.reload()    # if user changed config for tests while training
-                    with torch.no_grad():
+                    # stricter than no_grad(); also skips view tracking and version counter bumps
+                    with torch.inference_mode():
                         self.tests_types[self.exp.problem_type]()
             else:
                 log.warning(f"{self.exp.problem_type} dont have test runner yet. "
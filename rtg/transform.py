@@ -4,6 +4,7 @@ transformation of text
 import html
 from sacremoses import MosesTokenizer, MosesDetokenizer, MosesPunctNormalizer, MosesTruecaser
 from functools import partial
+from typing import List, Optional
 from rtg.registry import TRANSFORM, TRANSFORMS
 from rtg.utils import shell_pipe
 
@@ -68,6 +69,11 @@ class TextTransform:
     def recommended_post(cls) -> 'TextTransform':
         return cls.make(names=['moses_detok', 'drop_unk'])
 
+    @classmethod
+    def make_post(cls, names: Optional[List[str]]) -> 'TextTransform':
+        """post processor from the given names; the recommended one when names are not given"""
+        return cls.make(names=names) if names else cls.recommended_post()
+
     @classmethod
     def basic_pre(cls) -> 'TextTransform':
         return cls.make(names=['space_tok'])
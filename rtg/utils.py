@@ -1,7 +1,7 @@
 import gc
 import gzip
 import operator as op
-from functools import reduce
+from functools import reduce, lru_cache
 from pathlib import Path
 import torch
 from rtg import log
@@ -81,6 +81,22 @@ def line_count(path, ignore_blanks=False):
         return count
 
 
+@lru_cache(maxsize=None)
+def _line_count_cached(path: str, mtime_ns: int, size: int, ignore_blanks=False):
+    # mtime and size are part of the key, so the cache entry is invalidated when the file changes
+    return line_count(path, ignore_blanks=ignore_blanks)
+
+
+def cached_line_count(path, ignore_blanks=False):
+    """count number of lines in file; counts are remembered until the file is modified
+    :param path: file path
+    :param ignore_blanks: ignore blank lines
+    """
+    path = Path(path).resolve()
+    stat = path.stat()
+    return _line_count_cached(str(path), stat.st_mtime_ns, stat.st_size, ignore_blanks=ignore_blanks)
+
+
 def get_my_args(exclusions=None):
     """
     get args of your call. you = a function
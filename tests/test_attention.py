@@ -0,0 +1,46 @@
+import torch
+
+from rtg.module.tfmnmt import attention, MultiHeadedAttention
+
+
+def _compare(mask, batch=3, heads=4, q_len=5, k_len=7, dim=8):
+    torch.manual_seed(0)
+    query = torch.randn(batch, heads, q_len, dim)
+    key = torch.randn(batch, heads, k_len, dim)
+    value = torch.randn(batch, heads, k_len, dim)
+    ref, _ = attention(query, key, value, mask=mask, need_attn=True)
+    fused, _ = attention(query, key, value, mask=mask, need_attn=False)
+    assert not torch.isnan(fused).any()
+    assert torch.allclose(ref, fused, atol=1e-5)
+
+
+def test_attention_fused_src_mask():
+    lens = torch.tensor([7, 4, 1])
+    src_mask = (torch.arange(7).view(1, -1) < lens.view(-1, 1)).view(3, 1, 1, 7)  # [B x 1 x 1 x SrcLen]
+    _compare(src_mask)
+
+
+def test_attention_fused_tgt_mask():
+    lens = torch.tensor([6, 3, 1])
+    pad_mask = (torch.arange(6).view(1, -1) < lens.view(-1, 1)).view(3, 1, 1, 6)
+    causal_mask = torch.tril(torch.ones(6, 6, dtype=torch.bool)).view(1, 1, 6, 6)
+    _compare(pad_mask & causal_mask, q_len=6, k_len=6)
+
+
+def test_attention_fused_fully_masked_rows():
+    mask = torch.ones(3, 1, 5, 7, dtype=torch.bool)
+    mask[0] = False  # all rows of first item
+    mask[1, :, 2] = False  # one row of second item
+    _compare(mask)
+
+
+def test_multi_headed_attention_eval():
+    torch.manual_seed(0)
+    mha = MultiHeadedAttention(h=4, d_model=32, dropout=0.1).eval()
+    x = torch.randn(2, 6, 32)
+    mask = (torch.arange(6).view(1, -1) < torch.tensor([6, 3]).view(-1, 1)).view(2, 1, 6)
+    fused = mha(x, x, x, mask=mask)
+    mha.cache_attn = True
+    ref = mha(x, x, x, mask=mask)
+    assert mha.attn is not None
+    assert torch.allclose(ref, fused, atol=1e-5)
@@ -8,6 +8,10 @@ import tempfile
 from rtg.exp import load_conf
 import torch
 import shutil
+import json
+import math
+from pathlib import Path
+from rtg.pipeline import quasi_random_choices
 from . import sanity_check_experiment, run_decode
 
 
@@ -170,6 +174,131 @@ def test_byte_vocab():
         shutil.rmtree(tmp_dir, ignore_errors=True)
 
 
+def test_detokenize_lines_parallel(monkeypatch):
+    import rtg.pipeline
+    monkeypatch.setattr(rtg.pipeline, 'cpu_count', 4)  # ensure the pool is used, even on a single CPU
+    pipe = Pipeline(Experiment('experiments/sample-exp', read_only=True))
+    lines = Path('experiments/sample-data/sampl.valid.en.tok').read_text().splitlines()[:50]
+    lines = [f'{line}\t-0.5' for line in lines]  # like decoder output TSV
+    expected = list(pipe.detokenize_lines(lines, chunk_size=len(lines)))  # in process
+    got = list(pipe.detokenize_lines(lines, chunk_size=8))  # ceil(50/8) => 4 workers
+    assert got == expected
+
+
+def test_decode_autocast_invalid_dtype():
+    from rtg.pipeline import decode_autocast
+    decode_autocast(dict(autocast_dtype=None))
+    with pytest.raises(ValueError):
+        decode_autocast(dict(autocast_dtype='bf16'))
+
+
+def test_quasi_random_choices():
+    choices = [(1, 4, 8), (1, 5, 10), (0.0, 0.4, 0.6)]
+    for n in [1, 5, 8, 10]:
+        points = quasi_random_choices(n, *choices)
+        assert len(points) == n
+        for point in points:
+            assert len(point) == len(choices)
+            assert all(x in choice for x, choice in zip(point, choices))
+
+
+def _trained_tmp_exp(n_tune_lines=24):
+    """Trains a tiny experiment in a tmp dir; and makes a small tune set in it"""
+    tmp_dir = tempfile.mkdtemp()
+    config = load_conf('experiments/transformer.test.yml')
+    exp = Experiment(tmp_dir, config=config, read_only=False)
+    exp.config['trainer'].update(dict(steps=50, check_point=25))
+    exp.config['prep']['num_samples'] = 0
+    Pipeline(exp).run(run_tests=False)
+    tune_src, tune_ref = Path(tmp_dir) / 'tune.src', Path(tmp_dir) / 'tune.ref'
+    for orig, copy in [(config['prep']['valid_src'], tune_src), (config['prep']['valid_tgt_raw'], tune_ref)]:
+        lines = Path(orig).read_text().splitlines(keepends=True)[:n_tune_lines]
+        copy.write_text(''.join(lines))
+    return exp, tune_src, tune_ref
+
+
+def test_tune_decoder_params_with_pruning():
+    exp, tune_src, tune_ref = _trained_tmp_exp()
+    try:
+        space = dict(beam_size=(1, 2, 3), ensemble=(1,), lp_alpha=(0.0, 0.3, 0.6))
+        suggested = (1, 1, 0.0)
+        pipe = Pipeline(exp)
+        best_params, _ = pipe.tune_decoder_params(exp, tune_src=str(tune_src), tune_ref=str(tune_ref),
+                                                  batch_size=2000, trials=6, suggested=[suggested],
+                                                  prune_after_n_lines=8, max_len=50, **space)
+        assert all(best_params[name] in values for name, values in space.items())
+
+        _, step = exp.get_last_saved_model()
+        tune_dir = exp.work_dir / f'tune_step{step}'
+        partial, full = [{tuple(json.loads(line)['key']) for line in (tune_dir / name).read_text().splitlines()}
+                         for name in ['scores_n8.jsonl', 'scores.jsonl']]
+        assert len(partial) >= 2  # sampled candidates are ranked on prefix
+        assert suggested not in partial and suggested in full  # suggested are exempted from pruning
+        assert len(full) == 1 + math.ceil(math.sqrt(len(partial)))  # suggested + survivors
+        assert tuple(best_params[name] for name in ['beam_size', 'ensemble', 'lp_alpha']) in full
+    finally:
+        shutil.rmtree(exp.work_dir, ignore_errors=True)
+
+
+def test_tune_decoder_params_resume():
+    exp, tune_src, tune_ref = _trained_tmp_exp()
+    try:
+        _, step = exp.get_last_saved_model()
+        tune_dir = exp.work_dir / f'tune_step{step}'
+        tune_dir.mkdir(parents=True, exist_ok=True)
+        # legacy JSON with stringified tuple keys, and the newer JSONL
+        (tune_dir / 'scores.json').write_text(json.dumps({str((1, 1, 0.0)): 20.0}))
+        (tune_dir / 'scores.jsonl').write_text(json.dumps(dict(key=[2, 1, 0.6], score=30.0)) + '\n')
+
+        pipe = Pipeline(exp)
+        best_params, _ = pipe.tune_decoder_params(exp, tune_src=str(tune_src), tune_ref=str(tune_ref),
+                                                  batch_size=2000, trials=2, suggested=[(1, 1, 0.0), (2, 1, 0.6)],
+                                                  beam_size=(1, 2), ensemble=(1,), lp_alpha=(0.0, 0.6),
+                                                  prune_after_n_lines=0, max_len=50)
+        assert best_params == dict(beam_size=2, ensemble=1, lp_alpha=0.6)
+        assert not list(tune_dir.glob('*.out.tsv'))  # candidates in memory are not decoded again
+    finally:
+        shutil.rmtree(exp.work_dir, ignore_errors=True)
+
+
+def test_decoder_cache(monkeypatch):
+    from types import SimpleNamespace
+    from rtg.module.decoder import Decoder
+    monkeypatch.setattr(Decoder, 'new', classmethod(lambda cls, exp, ensemble: SimpleNamespace(ensemble=ensemble)))
+    exp = SimpleNamespace(work_dir=Path('/tmp/no-such-exp'), get_last_saved_model=lambda: (None, 100))
+    pipe = Pipeline(exp, max_cached_decoders=2)
+    dec1 = pipe.get_decoder(exp, ensemble=1)
+    assert pipe.get_decoder(exp, ensemble=1) is dec1  # hit
+    dec2 = pipe.get_decoder(exp, ensemble=2)
+    pipe.get_decoder(exp, ensemble=1)  # ensemble=2 is now the least recently used
+    pipe.get_decoder(exp, ensemble=3)  # evicts ensemble=2
+    assert sorted(key[-1] for key in pipe._decoder_cache) == [1, 3]
+    assert pipe.get_decoder(exp, ensemble=1) is dec1
+    assert pipe.get_decoder(exp, ensemble=2) is not dec2  # reloaded; evicts ensemble=3
+    assert sorted(key[-1] for key in pipe._decoder_cache) == [1, 2]
+
+    pipe.clear_decoders(keep_ensembles=[2])
+    assert [key[-1] for key in pipe._decoder_cache] == [2]
+    pipe.clear_decoders()
+    assert not pipe._decoder_cache
+
+
+def test_cached_bleu_metric():
+    import sacrebleu
+    pipe = Pipeline(Experiment('experiments/sample-exp', read_only=True))
+    ref = ['The cat sat on the mat .', 'A quick brown fox jumps over the lazy dog .', 'Hello World !']
+    hyps = [['the cat sat on a mat .', 'A fast brown fox jumped over the lazy dog .', 'hello world'],
+            ['The cat is on the mat .', 'quick brown fox jumps over lazy dog .', 'Hello World !']]
+    for lowercase in [True, False]:
+        metric = pipe.get_bleu_metric(ref, lowercase=lowercase)
+        for hyp in hyps:
+            assert pipe.get_bleu_metric(list(ref), lowercase=lowercase) is metric  # hit
+            expected = sacrebleu.corpus_bleu(hyp, [ref], lowercase=lowercase)
+            assert metric.corpus_score(hyp, None).score == pytest.approx(expected.score)
+    pipe.clear_bleu_cache()
+    assert pipe.get_bleu_metric(ref) is not metric
+
+
 if __name__ == '__main__':
     from multiprocessing import freeze_support
     freeze_support()   # required for parallel nlcodec
@@ -0,0 +1,28 @@
+import math
+from torch import nn
+from rtg.module.schedule import Noam, InverseSqrt, ScheduledOptimizer
+
+
+def test_noam_rate():
+    noam = Noam(warmup=4000, constant=2, model_dim=512)
+    for step in [1, 10, 3999, 4000, 4001, 10_000, 100_000]:
+        expected = 2 * 512 ** -0.5 * min(step ** -0.5, step * 4000 ** -1.5)
+        assert math.isclose(noam.rate(step), expected, rel_tol=1e-9)
+
+
+def test_inverse_sqrt_rate():
+    sched = InverseSqrt(warmup=100, peak_lr=1e-3, init_lr=1e-5, constant=2)
+    for step in [1, 50, 99, 100, 101, 1000, 100_000]:
+        if step <= 100:
+            expected = 1e-5 + step * (1e-3 - 1e-5) / 100
+        else:
+            expected = 1e-3 * 100 ** 0.5 * step ** -0.5
+        assert math.isclose(sched.rate(step), 2 * expected, rel_tol=1e-9)
+
+
+def test_vaswani_etal_opt_cpu_params():
+    model = nn.Linear(4, 3)
+    # a generator, as from model.parameters(); CPU params can not use fused Adam even if a GPU is available
+    opt = ScheduledOptimizer.get_vaswani_etal_opt(model.parameters(), model_dim=4)
+    assert not opt.optimizer.defaults.get('fused')
+    assert len(opt.param_groups[0]['params']) == 2
@@ -0,0 +1,20 @@
+import os
+import tempfile
+from pathlib import Path
+
+from rtg.utils import cached_line_count
+
+
+def test_cached_line_count_updates_on_rewrite():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / 'lines.txt'
+        path.write_text('a\nb\n')
+        assert cached_line_count(path) == 2
+        assert cached_line_count(path) == 2  # cache hit
+
+        stat = path.stat()
+        path.write_text('abc\n')  # same size, different line count
+        # ensure a different mtime even on file systems with coarse timestamps
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        assert path.stat().st_size == stat.st_size
+        assert cached_line_count(path) == 1